@@ -1,21 +1,124 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, FrozenSet, Tuple
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 import os
-import sys
 import re
-import numpy as np
-from glob import glob
+from pathlib import Path
+from enum import Enum
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import typer
-import datetime
 from tqdm import tqdm
 
+# python-calamine parses xlsx files much faster than openpyxl. openpyxl is used if it isn't installed (pandas already opens the workbook read-only)
+try:
+    import python_calamine  # noqa: F401
+
+    EXCEL_ENGINE: str = "calamine"
+
+except ImportError:
+
+    EXCEL_ENGINE: str = "openpyxl"
+
+# hyperscan is optional. If it is installed the mutation consequences are scanned with it instead of the python regex engine
+try:
+    import hyperscan
+
+except ImportError:
+
+    hyperscan = None
+
 app = typer.Typer(add_completion=False)
 
+class GeneFileError(ValueError):
+    """error raised when one of the input files is missing or doesn't have the expected columns"""
+
+class OutputFormat(str, Enum):
+    """file formats that the aggregated probes can be written in"""
+    tsv = "tsv"
+    parquet = "parquet"
+    feather = "feather"
+
+# annotation files are expected to have the format ChrXX where XX is a number
+_CHR_RE: re.Pattern = re.compile(r'Chr\d\d')
+
+# columns that are read from the annotation files. The chromosome 6 file uses different column names
+REQUIRED_COLS: Tuple[str, ...] = ("name", "RsID", "Chr", "MapInfo", "Alleles", "Transcript", "Gene(s)", "In-exon", "Mutation(s)")
+
+CHR06_COLS: Tuple[str, ...] = ("IlmnID", "RS Name", "Chr", "MapInfo", "SNP", "Gene(s)", "In-exon", "Mutation(s)")
+
+# mapping from the chromosome 6 column names to the names used in the other files and the output
+CHR06_RENAME: Dict[str, str] = {"IlmnID": "name", "RS Name": "RsID", "SNP": "Alleles"}
+
+# every column except the position is read as a string so pandas doesn't have to infer the type and doesn't turn genes into dates
+REQUIRED_DTYPES: Dict[str, type] = {col: str for col in REQUIRED_COLS if col != "MapInfo"}
+
+CHR06_DTYPES: Dict[str, type] = {col: str for col in CHR06_COLS if col != "MapInfo"}
+
+# columns that only have a few distinct values so they are stored as categories
+CATEGORY_COLS: Tuple[str, ...] = ("Chr", "Gene(s)", "In-exon", "Mutation(s)")
+
+# arrow schema for the parquet and feather outputs so the column types don't depend on what pandas inferred for the combined files
+OUTPUT_SCHEMA: pa.Schema = pa.schema([
+    ("name", pa.string()),
+    ("RsID", pa.string()),
+    ("Chr", pa.dictionary(pa.int8(), pa.string())),
+    ("MapInfo", pa.int64()),
+    ("Alleles", pa.string()),
+    ("Transcript", pa.string()),
+    ("Gene(s)", pa.dictionary(pa.int32(), pa.string())),
+    ("In-exon", pa.dictionary(pa.int8(), pa.string())),
+    ("Mutation(s)", pa.dictionary(pa.int32(), pa.string())),
+])
+
 class Filter:
     """class that will apply the regex filter to find either the missense/nonse variants or all of them"""
+    ALL_SNPS_PATTERN: re.Pattern = re.compile(r'Missense|Nonsense|Silent|Synonymous')
+
+    PATHOGENIC_PATTERN: re.Pattern = re.compile(r'Missense|Nonsense')
+
     def __init__(self, find_all_snps: bool) -> None:
-        # This attribute will be tree or false
-        self.snps_to_gather: bool = find_all_snps
+        # picking the compiled pattern once so that each file reuses it
+        self._pat: re.Pattern = self.ALL_SNPS_PATTERN if find_all_snps else self.PATHOGENIC_PATTERN
+
+        self._db = None
+
+        if hyperscan is not None:
+
+            self._db = hyperscan.Database()
+
+            self._db.compile(expressions=[self._pat.pattern.encode()], ids=[0], flags=[hyperscan.HS_FLAG_SINGLEMATCH])
+
+    def _contains_hs(self, mutations: pd.Series) -> np.ndarray:
+        """function that uses the hyperscan database to find which mutation consequences match the pattern
+        Parameter
+        _________
+        mutations : pd.Series
+            series that has the mutation consequences for each probe
+
+        Return
+        ______
+        np.ndarray
+            boolean array that is True for each probe whose mutation consequence matches the pattern
+        """
+        # only the distinct values are scanned. factorize gives missing values a code of -1
+        codes, uniques = pd.factorize(mutations)
+
+        # the extra False at the end is what the -1 codes of missing values pick up
+        matches: np.ndarray = np.zeros(len(uniques) + 1, dtype=bool)
+
+        def on_match(pattern_id: int, start: int, end: int, flags: int, index: int) -> None:
+            matches[index] = True
+
+        for index, value in enumerate(uniques):
+
+            self._db.scan(str(value).encode(), match_event_handler=on_match, context=index)
+
+        return matches[codes]
 
     def filter_for_pathogenicity(self, variant_df: pd.DataFrame) -> pd.DataFrame:
         """function that will filter the provided dataframe for variants based on if an argument is passed. If the self attribute is True then all the variants will be returned otherwise just the pathogenic ones will be 
@@ -29,14 +132,11 @@ class Filter:
         pd.DataFrame
             dataframe that either only has missense/nonsense variants or has all the variants
         """
-        # if the user chooses to keep all snps then
-        if self.snps_to_gather:
-            
-            return variant_df[variant_df["Mutation(s)"].str.contains(r'Missense|Nonsense|Silent|Synonymous', na=False)]
+        if self._db is not None:
 
-        else:
+            return variant_df[self._contains_hs(variant_df["Mutation(s)"])]
 
-            return variant_df[variant_df["Mutation(s)"].str.contains(r'Missense|Nonsense', na=False)]
+        return variant_df[variant_df["Mutation(s)"].str.contains(self._pat, na=False)]
 
 def get_files(file_directory: str) -> List[str]:
     """Function that can get all the annotated excel files from the specified directory
@@ -50,31 +150,15 @@ def get_files(file_directory: str) -> List[str]:
     List[str]
         returns a list of strings that has all the file paths to the annotation files in it
     """
-    cur_dir: str = os.getcwd()
-
-    annotation_file_list: List[str] = []
-
-    os.chdir(file_directory)
-
-    # gathering all the files that have and .xlsx extension and iterating through them
-    for file in glob("*.xlsx"):
-
-        full_file_path: str = os.path.join(file_directory, file)
-
-        # check to make sure that the file has the format ChrXX where XX is a number
-        match_string: str = re.search(r'Chr\d\d', file)
-
-        if match_string:
-
-            annotation_file_list.append(full_file_path)
+    # gathering all the files that have an .xlsx extension and the format ChrXX where XX is a number. Sorting keeps the output in chromosome order
+    annotation_file_list: List[str] = sorted(
+        str(path) for path in Path(file_directory).glob("*.xlsx") if _CHR_RE.search(path.name)
+    )
     
     # if there are no files detected in the provided directory then the program needs to end
     if len(annotation_file_list) == 0:
 
-        print("There were no annotation files found in the specified directory. Please ensure that there are excel annotation files. Ending program now...")
-        sys.exit(0)
-
-    os.chdir(cur_dir)
+        raise GeneFileError("There were no annotation files found in the specified directory. Please ensure that there are excel annotation files")
 
     return annotation_file_list
 
@@ -90,43 +174,156 @@ def get_gene_list(gene_file: str) -> List[str]:
     List[str]
         list of strings that has the genes from the file of interest
     """
-    gene_df: pd.DataFrame = pd.read_csv(gene_file, sep="\t")
+    # the genes are always read as strings so gene names that look like numbers are kept as they are
+    gene_table: pa.Table = pa_csv.read_csv(
+        gene_file,
+        parse_options=pa_csv.ParseOptions(delimiter="\t"),
+        convert_options=pa_csv.ConvertOptions(column_types={"gene": pa.string()}),
+    )
     
-    if "gene" not in gene_df.columns:
-        print("expected the input file with gene targets to have a column named gene. This column was not found")
-        sys.exit(0)
+    if "gene" not in gene_table.column_names:
+        raise GeneFileError("expected the input file with gene targets to have a column named gene. This column was not found")
 
-    return gene_df.gene.values.tolist()
+    # blank rows are skipped so they don't end up as an empty gene in the gene pattern
+    return [gene for gene in gene_table.column("gene").to_pylist() if gene]
 
-def filter(row: str, list: List[str]):
+def _cached_read(file: str, is_chr06: bool) -> pd.DataFrame:
+    """function that reads the needed columns of an annotation file. The parsed columns are cached in a parquet file next to the excel file so later runs don't have to parse the excel file again
+    Parameters
+    __________
+    file : str
+        file path to the mega annotation file for one chromosome
 
-    if type(row) == datetime.datetime:
-        return np.nan
+    is_chr06 : bool
+        boolean value for whether or not the file is the chromosome 6 file which has a different layout
 
-    split_row: list = row.split(",")
+    Returns
+    _______
+    pd.DataFrame
+        dataframe that has the required columns from the annotation file
+    """
+    cache_path: str = file + ".parquet"
 
-    for element in split_row:
+    # the cache is only used if it was written after the excel file was last modified. A cache that can't be read is ignored and rewritten from the excel file
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file):
 
-        if element in list:
-            return ",".join(split_row)
-            
-    
-    return np.nan
+        try:
+            return pd.read_parquet(cache_path)
 
-def remove_previous_file(output_name: str):
-    """function to check if the output file exist from a previous run and deletes it if exist
-    Parameter
-    _________
-    output_name : str
-        string that list the output file path
-    """
+        except (OSError, ValueError):
+            pass
+
+    with pd.ExcelFile(file, engine=EXCEL_ENGINE) as excel_file:
+
+        if is_chr06 and "cleaned" not in excel_file.sheet_names:
+
+            raise GeneFileError(f"expected the chromosome 6 file {file} to have a sheet named cleaned")
+
+        # only the columns that are written to the output are parsed. pandas raises a ValueError if any are missing
+        try:
+            if is_chr06:
+
+                file_df: pd.DataFrame = excel_file.parse(sheet_name="cleaned", usecols=CHR06_COLS, dtype=CHR06_DTYPES)
+
+            else:
+                file_df: pd.DataFrame = excel_file.parse(usecols=REQUIRED_COLS, dtype=REQUIRED_DTYPES)
+
+        except ValueError as error:
+
+            raise GeneFileError(f"expected the columns {', '.join(CHR06_COLS if is_chr06 else REQUIRED_COLS)} to be in the file {file}") from error
+
+    # writing to a temporary file first so an interrupted run can't leave a partial cache behind. If the directory isn't writable the excel file is just parsed again next time
     try:
-        os.remove(output_name)
+        file_df.to_parquet(cache_path + ".tmp", index=False)
+
+        os.replace(cache_path + ".tmp", cache_path)
 
-    except FileNotFoundError:
+    except OSError:
         pass
 
-def find_variant_snps(file_list: List[str], gene_list: List[str], output_path: str, aggregate_all_probes: bool):
+    return file_df
+
+def _process_file(file: str, gene_pat: re.Pattern, aggregate_all_probes: bool) -> pd.DataFrame:
+    """function that reads in one annotation file and keeps the probes for the genes of interest. This runs in a worker process so it can't rely on any state from the main process
+    Parameters
+    __________
+    file : str
+        file path to the mega annotation file for one chromosome
+
+    gene_pat : re.Pattern
+        compiled pattern that matches a comma separated gene cell if it contains any of the genes of interest
+
+    aggregate_all_probes : bool
+        boolean value for whether or not the user wants to keep all the probes or only the missense/nonsense ones
+
+    Returns
+    _______
+    pd.DataFrame
+        dataframe that has the probes for the genes of interest in the output column layout
+    """
+    # creating a filter type
+    filter_object: Filter = Filter(aggregate_all_probes)
+
+    # the chromosome 6 file has a different layout than the other annotation files
+    is_chr06: bool = "Chr06" in os.path.basename(file)
+
+    file_df: pd.DataFrame = _cached_read(file, is_chr06)
+
+    # only probes without a gene are dropped. Missing values in the other columns, such as a probe without a transcript, are kept
+    file_df = file_df.dropna(subset=["Gene(s)"])
+
+    # the string matches below only have to run once per category instead of once per row
+    file_df = file_df.astype({col: "category" for col in CATEGORY_COLS})
+
+    # marking the rows where at least one gene in the cell is a gene of interest
+    gene_mask: pd.Series = file_df["Gene(s)"].str.contains(gene_pat, na=False)
+
+    filtered_df: pd.DataFrame = filter_object.filter_for_pathogenicity(file_df[gene_mask])
+
+    # the chromosome 6 columns are renamed even if no probes were found so that every file has the same columns when they are combined
+    if is_chr06:
+
+        filtered_df = filtered_df.rename(columns=CHR06_RENAME)
+
+        # the chromosome 6 file doesn't have transcripts
+        filtered_df["Transcript"] = pd.NA
+
+        filtered_df = filtered_df[list(REQUIRED_COLS)]
+
+    return filtered_df
+
+def write_output(output_df: pd.DataFrame, output_path: str, output_format: OutputFormat):
+    """function that writes the aggregated probes in the requested file format
+    Parameters
+    __________
+    output_df : pd.DataFrame
+        dataframe that has the probes from all of the annotation files
+
+    output_path : str
+        string that list the output file path (including the filename)
+
+    output_format : OutputFormat
+        file format to write the output in
+    """
+    if output_format == OutputFormat.tsv:
+
+        output_df.to_csv(output_path, sep="\t", index=False)
+
+        return
+
+    # the categories of each file are lost when the files are combined so they are rebuilt here before they become dictionary columns
+    output_df = output_df.astype({col: "category" for col in CATEGORY_COLS})
+
+    output_table: pa.Table = pa.Table.from_pandas(output_df, schema=OUTPUT_SCHEMA, preserve_index=False)
+
+    if output_format == OutputFormat.parquet:
+
+        pq.write_table(output_table, output_path, compression="zstd")
+
+    else:
+        feather.write_feather(output_table, output_path)
+
+def find_variant_snps(file_list: List[str], gene_list: List[str], output_path: str, aggregate_all_probes: bool, output_format: OutputFormat = OutputFormat.tsv):
     """Function to find the variant snps on the mega probe for a specific gene 
     Parameters
     __________
@@ -141,73 +338,39 @@ def find_variant_snps(file_list: List[str], gene_list: List[str], output_path: s
 
     aggregate_all_probes : bool
         boolean value for whether or not the user wants to keep all the probes or only the missense/nonsense ones
-    """
-    # looking for the gene in each of the files
-
-    # creating a filter type
-    filter_object: Filter = Filter(aggregate_all_probes)
-
-    result = 0
-    for i in tqdm(range(len(file_list))):
-        
-        file = file_list[i]
 
-        if re.match(r".*Chr06.*", file): 
-
-            file_df: pd.DataFrame = pd.read_excel(file, sheet_name="cleaned")
-        
-        else:
-            file_df: pd.DataFrame = pd.read_excel(file)
+    output_format : OutputFormat
+        file format to write the output in. Defaults to a tab separated file
+    """
+    # removing duplicate genes so each gene only shows up once in the pattern. The genes are sorted so the pattern is the same between runs
+    gene_set: FrozenSet[str] = frozenset(gene_list)
 
-        if "Gene(s)" not in file_df.columns:
+    # one pattern that matches any of the genes as a whole element of the comma separated Gene(s) cell. Without any genes the alternation would be empty and match any cell with an empty element, so a pattern that never matches is used instead
+    if gene_set:
 
-            print("expected a column called Gene(s) to be in the file")
-            sys.exit(1)
+        gene_pat: re.Pattern = re.compile("(?:^|,)(?:" + "|".join(re.escape(gene) for gene in sorted(gene_set)) + ")(?:,|$)")
 
-        file_df = file_df.dropna()
-        
-        file_df["Genes"] = file_df["Gene(s)"].apply(lambda row: filter(row, gene_list))
-        
-        filtered_df: pd.DataFrame = file_df.dropna()
+    else:
+        gene_pat: re.Pattern = re.compile(r"(?!)")
 
-        if not filtered_df.empty:
+    # each annotation file is independent so they are parsed in parallel across processes
+    process_file = partial(_process_file, gene_pat=gene_pat, aggregate_all_probes=aggregate_all_probes)
 
-            filtered_df = filter_object.filter_for_pathogenicity(filtered_df)
-            
-            if re.match(r".*Chr06.*", file): 
-                
-                file_info_dict: Dict[str, Optional[List]] = {
-                    "name":filtered_df.IlmnID.values.tolist(), 
-                    "RsID":filtered_df["RS Name"].values.tolist(),
-                    "Chr": filtered_df.Chr.values.tolist(),
-                    "MapInfo": filtered_df.MapInfo.values.tolist(),
-                    "Alleles": filtered_df.SNP.values.tolist(),
-                    "Transcript":None,
-                    "Gene(s)":filtered_df["Gene(s)"].values.tolist(),
-                    "In-exon": filtered_df["In-exon"].values.tolist(),
-                    "Mutation(s)": filtered_df["Mutation(s)"].values.tolist()
-                    }
-                
-                file_info_df: pd.DataFrame = pd.DataFrame.from_dict(file_info_dict)
-
-                file_info_df = file_info_df.drop(["Genes"], axis=1)
-
-                filtered_df = file_info_df
+    with ProcessPoolExecutor() as executor:
 
-            else:
+        file_dfs: List[pd.DataFrame] = list(tqdm(executor.map(process_file, file_list), total=len(file_list)))
 
-                filtered_df = filtered_df.drop(["Genes"], axis=1)
+    # files without any probes for the genes are left out of the concat. If none of the files had probes then only the header is written
+    parts: List[pd.DataFrame] = [file_df for file_df in file_dfs if not file_df.empty]
 
-                
-        if result == 0:
+    if parts:
 
-            filtered_df.to_csv(output_path, sep="\t", mode="a+", index=False)
+        output_df: pd.DataFrame = pd.concat(parts, ignore_index=True)
 
-        else:
+    else:
+        output_df: pd.DataFrame = pd.DataFrame(columns=list(REQUIRED_COLS))
 
-            filtered_df.to_csv(output_path, sep="\t", mode="a+", index=False, header=False)
-
-        result += 1
+    write_output(output_df, output_path, output_format)
 
 @app.command()
 def get_variants(
@@ -220,7 +383,8 @@ def get_variants(
     gene_target_file: str = typer.Argument(
         ..., help="String that list the file path to a text file that has one column that has gene targets for the program. This file should have a column named 'gene'"
     ), 
-    gather_all_snps: bool = typer.Option(False, help="Argument to indicate if the program should return all variant probes whose mutation consequences are known or if the program should only return the missense/nonsense probes")
+    gather_all_snps: bool = typer.Option(False, help="Argument to indicate if the program should return all variant probes whose mutation consequences are known or if the program should only return the missense/nonsense probes"),
+    output_format: OutputFormat = typer.Option(OutputFormat.tsv, "--format", help="File format to write the output in. Parquet and feather files are much faster to write and load than the default tab separated file")
     ):
     """
     main function to generate a file that contains all pathogenic snps for genes of interests from the annotated mega files
@@ -230,16 +394,21 @@ def get_variants(
     print(f"Gene Targets File: {gene_target_file}")
     print(f"Output File: {output_filepath}\n")
 
-    remove_previous_file(output_filepath)
+    # problems with the input files are reported here so the helper functions can raise them from worker processes
+    try:
+        # getting a list that has all of the annotation files
+
+        file_list: List[str] = get_files(annotation_file_dir)
 
-    # getting a list that has all of the annotation files
+        gene_list: List[str] = get_gene_list(gene_target_file)
 
-    file_list: List[str] = get_files(annotation_file_dir)
+        # getting all the snps for a specific variant
+        find_variant_snps(file_list, gene_list, output_filepath, gather_all_snps, output_format)
 
-    gene_list: List[str] = get_gene_list(gene_target_file)
+    except GeneFileError as error:
 
-    # getting all the snps for a specific variant
-    find_variant_snps(file_list, gene_list, output_filepath, gather_all_snps)
+        typer.echo(str(error), err=True)
+        raise typer.Exit(code=1)
 
 if __name__ == '__main__':
     app()
\ No newline at end of file